@@ -1,10 +1,48 @@
-from typing import Final
+import struct
+from typing import Any, Callable, Final, NamedTuple
+
+
+_MEMORY_SIZE: Final = 65536
+_BLANK_MEMORY: Final = bytes(_MEMORY_SIZE)
+_U16: Final = struct.Struct("<H")
+_U32: Final = struct.Struct("<I")
 
 
 class InputRequired(Exception):
     pass
 
 
+class CPUState(NamedTuple):
+    PC: int
+    A: int
+    X: int
+    Y: int
+    SP: int
+    P: int
+    cycles: int
+
+    def to_dict(self) -> dict[str, Any]:
+        p = self.P
+        return {
+            "PC": self.PC,
+            "A": self.A,
+            "X": self.X,
+            "Y": self.Y,
+            "SP": self.SP,
+            "P": p,
+            "cycles": self.cycles,
+            "flags": {
+                "C": (p & CPU6502.CARRY) != 0,
+                "Z": (p & CPU6502.ZERO) != 0,
+                "I": (p & CPU6502.IRQ) != 0,
+                "D": (p & CPU6502.DECIMAL) != 0,
+                "B": (p & CPU6502.BRK) != 0,
+                "V": (p & CPU6502.OVERFLOW) != 0,
+                "N": (p & CPU6502.NEGATIVE) != 0,
+            },
+        }
+
+
 class CPU6502:
     MASK16: Final = 0xFFFF
     MASK32: Final = 0xFFFFFFFF
@@ -18,13 +56,18 @@ class CPU6502:
     NEGATIVE: Final = 0x80
 
     def __init__(self, input_provider=None, output_handler=None):
+        self.memory = bytearray(_MEMORY_SIZE)
+        self.reset(input_provider, output_handler)
+        self._dispatch = _build_handlers(self)
+
+    def reset(self, input_provider=None, output_handler=None):
         self._A = 0x0000
         self._X = 0x0000
         self._Y = 0x0000
         self._SP = 0xFD
         self._PC = 0x0000
         self._P = 0b0010_0000
-        self.memory = [0x00] * 65536
+        self.memory[:] = _BLANK_MEMORY
         self.cycles = 0
         self._input_provider = input_provider or self._default_input_provider
         self._output_handler = output_handler or self._default_output_handler
@@ -95,47 +138,66 @@ class CPU6502:
     def update_zn_flags(self, value, bits: int = 16):
         mask = (1 << bits) - 1
         sign_bit = 1 << (bits - 1)
-        self.Z = (value & mask) == 0
-        self.N = (value & sign_bit) != 0
-
-    def branch(self, condition):
-        offset = self.memory[self._PC]
-        self._PC += 1
-        if offset >= 0x80:
-            offset -= 0x100
+        p = self._P & ~(self.ZERO | self.NEGATIVE)
+        if not value & mask:
+            p |= self.ZERO
+        if value & sign_bit:
+            p |= self.NEGATIVE
+        self._P = p
+
+    def _set_czn_flags(self, carry, result):
+        p = self._P & ~(self.CARRY | self.ZERO | self.NEGATIVE)
+        if carry:
+            p |= self.CARRY
+        if not result:
+            p |= self.ZERO
+        if result & 0x8000:
+            p |= self.NEGATIVE
+        self._P = p
+
+    def branch(self, condition, offset):
         if condition:
-            self._PC = (self._PC + offset) & 0xFFFF
+            self._PC = (self._PC + ((offset ^ 0x80) - 0x80)) & 0xFFFF
             self.cycles += 3
         else:
             self.cycles += 2
 
     def _read16(self, addr: int) -> int:
-        low = self.memory[addr & 0xFFFF]
-        high = self.memory[(addr + 1) & 0xFFFF]
-        return ((high << 8) | low) & self.MASK16
+        memory = self.memory
+        return memory[addr & 0xFFFF] | (memory[(addr + 1) & 0xFFFF] << 8)
 
     def _write16(self, addr: int, value: int) -> None:
         addr &= 0xFFFF
         value &= self.MASK16
+        if addr < 0xFFFF:
+            _U16.pack_into(self.memory, addr, value)
+            return
         self.memory[addr] = value & 0xFF
-        self.memory[(addr + 1) & 0xFFFF] = (value >> 8) & 0xFF
+        self.memory[0] = value >> 8
 
     def _read32(self, addr: int) -> int:
         addr &= 0xFFFF
+        if addr <= 0xFFFC:
+            return _U32.unpack_from(self.memory, addr)[0]
+        memory = self.memory
         return (
-            self.memory[addr]
-            | (self.memory[(addr + 1) & 0xFFFF] << 8)
-            | (self.memory[(addr + 2) & 0xFFFF] << 16)
-            | (self.memory[(addr + 3) & 0xFFFF] << 24)
-        ) & self.MASK32
+            memory[addr]
+            | (memory[(addr + 1) & 0xFFFF] << 8)
+            | (memory[(addr + 2) & 0xFFFF] << 16)
+            | (memory[(addr + 3) & 0xFFFF] << 24)
+        )
 
     def _write32(self, addr: int, value: int) -> None:
         addr &= 0xFFFF
         value &= self.MASK32
-        self.memory[addr] = value & 0xFF
-        self.memory[(addr + 1) & 0xFFFF] = (value >> 8) & 0xFF
-        self.memory[(addr + 2) & 0xFFFF] = (value >> 16) & 0xFF
-        self.memory[(addr + 3) & 0xFFFF] = (value >> 24) & 0xFF
+        if addr <= 0xFFFC:
+            _U32.pack_into(self.memory, addr, value)
+            return
+        memory = self.memory
+        memory[addr] = value & 0xFF
+        memory[(addr + 1) & 0xFFFF] = (value >> 8) & 0xFF
+        memory[(addr + 2) & 0xFFFF] = (value >> 16) & 0xFF
+        memory[(addr + 3) & 0xFFFF] = (value >> 24) & 0xFF
 
     def __str__(self):
         flags = (
@@ -153,25 +215,22 @@ class CPU6502:
             f"SP:${self._SP:02X}  P:${self._P:02X}  {flags}  cycles:{self.cycles}"
         )
 
-    def snapshot(self):
-        return {
-            "PC": self._PC & 0xFFFF,
-            "A": self._A & self.MASK32,
-            "X": self._X & self.MASK32,
-            "Y": self._Y & self.MASK32,
-            "SP": self._SP & 0xFF,
-            "P": self._P & 0xFF,
-            "cycles": self.cycles,
-            "flags": {
-                "C": self.C,
-                "Z": self.Z,
-                "I": self.I,
-                "D": self.D,
-                "B": self.B,
-                "V": self.V,
-                "N": self.N,
-            },
-        }
+    def snapshot_tuple(self) -> tuple[int, int, int, int, int, int, int]:
+        return (
+            self._PC & 0xFFFF,
+            self._A & self.MASK32,
+            self._X & self.MASK32,
+            self._Y & self.MASK32,
+            self._SP & 0xFF,
+            self._P & 0xFF,
+            self.cycles,
+        )
+
+    def snapshot(self) -> CPUState:
+        return CPUState._make(self.snapshot_tuple())
+
+    def snapshot_dict(self) -> dict[str, Any]:
+        return self.snapshot().to_dict()
 
     def LDA(self, value):
         self._A = value & self.MASK16
@@ -189,40 +248,52 @@ class CPU6502:
         self.cycles += 2
 
     def ADC(self, value):
-        total = self._A + value + (1 if self.C else 0)
+        a = self._A
+        p = self._P
+        total = a + value + (p & self.CARRY)
         result = total & self.MASK16
-        self.V = ((self._A ^ result) & (value ^ result) & 0x8000) != 0
-        self.C = total > self.MASK16
+        p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
+        if total > self.MASK16:
+            p |= self.CARRY
+        if not result:
+            p |= self.ZERO
+        if (a ^ result) & (value ^ result) & 0x8000:
+            p |= self.OVERFLOW
+        if result & 0x8000:
+            p |= self.NEGATIVE
+        self._P = p
         self._A = result
-        self.update_zn_flags(self._A)
         self.cycles += 2
 
     def SBC(self, value):
-        total = self._A - value - (0 if self.C else 1)
+        a = self._A
+        p = self._P
+        total = a - value - (1 - (p & self.CARRY))
         result = total & self.MASK16
-        self.V = ((self._A ^ result) & ((~value) ^ result) & 0x8000) != 0
-        self.C = total >= 0
+        p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
+        if total >= 0:
+            p |= self.CARRY
+        if not result:
+            p |= self.ZERO
+        if (a ^ result) & ((~value) ^ result) & 0x8000:
+            p |= self.OVERFLOW
+        if result & 0x8000:
+            p |= self.NEGATIVE
+        self._P = p
         self._A = result
-        self.update_zn_flags(self._A)
         self.cycles += 2
 
     def CMP(self, value):
-        diff = self._A - value
-        self.update_zn_flags(diff & self.MASK16)
-        self.C = self._A >= value
+        self._set_czn_flags(self._A >= value, (self._A - value) & self.MASK16)
         self.cycles += 2
 
     def CMPC(self, addr):
         value = self._read16(addr)
-        diff = self._A - value
-        self.update_zn_flags(diff & self.MASK16)
-        self.C = self._A >= value
+        self._set_czn_flags(self._A >= value, (self._A - value) & self.MASK16)
         self.cycles += 4
 
     def CPX(self, value):
-        diff = self._X - value
-        self.update_zn_flags(diff & self.MASK16)
-        self.C = self._X >= value
+        self._set_czn_flags(self._X >= value, (self._X - value) & self.MASK16)
         self.cycles += 2
 
     def AND(self, value):
@@ -251,7 +322,7 @@ class CPU6502:
         self.cycles += 2
 
     def CLC(self):
-        self.C = False
+        self._P &= ~self.CARRY
         self.cycles += 1
 
     def NOP(self):
@@ -280,13 +351,9 @@ class CPU6502:
         self.cycles += 4
 
     def clear_all_flags(self):
-        self.C = False
-        self.Z = False
-        self.I = False
-        self.D = False
-        self.B = False
-        self.V = False
-        self.N = False
+        self._P &= ~(
+            self.CARRY | self.ZERO | self.IRQ | self.DECIMAL | self.BRK | self.OVERFLOW | self.NEGATIVE
+        )
 
     def from_store_to_X(self, addr):
         self._X = self._read16(addr)
@@ -336,138 +403,260 @@ class CPU6502:
         self.update_zn_flags(result)
         self.cycles += 6
 
-    def execute_instructions(self):
-        op = self.memory[self._PC]
-        self._PC += 1
-
-        if op == 0x00:
-            return False
-        elif op == 0x01:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.A_to_store(addr)
-        elif op == 0x02:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.from_store_to_A(addr)
-        elif op == 0x03:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.X_to_store(addr)
-        elif op == 0x04:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.from_store_to_X(addr)
-        elif op == 0x05:
-            self.from_console_to_A()
-        elif op == 0x06:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.Output_to_console(addr)
-        elif op == 0x07:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.MUL(addr)
-        elif op == 0x08:
-            self.XTA()
-        elif op == 0x09:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.ORA(value)
-        elif op == 0x10:
-            self.branch(not self.N)
-        elif op == 0x11:
-            self.clear_all_flags()
-        elif op == 0x12:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.A_to_store_long(addr)
-        elif op == 0x13:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.from_store_long_to_A(addr)
-        elif op == 0x14:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.MULM(addr)
-        elif op == 0x15:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.Output_long_to_console(addr)
-        elif op == 0x16:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.MULL(addr)
-        elif op == 0x17:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.addr_plus_a(addr)  # This instruction doesn't do anything by itself, but can b
-        elif op == 0x18:
-            self.CLC()
-        elif op == 0x29:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.AND(value)
-        elif op == 0x30:
-            self.branch(self.N)
-        elif op == 0x49:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.EOR(value)
-        elif op == 0x4C:
-            low = self.memory[self._PC]
-            high = self.memory[self._PC + 1]
-            self._PC = (high << 8) | low
-            self.cycles += 3
-        elif op == 0x50:
-            self.branch(not self.V)
-        elif op == 0x69:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.ADC(value)
-        elif op == 0x70:
-            self.branch(self.V)
-        elif op == 0x90:
-            self.branch(not self.C)
-        elif op == 0xA0:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.LDY(value)
-        elif op == 0xA2:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.LDX(value)
-        elif op == 0xA9:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.LDA(value)
-        elif op == 0xAA:
-            self.TAX()
-        elif op == 0xB0:
-            self.branch(self.C)
-        elif op == 0xC9:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.CMP(value)
-        elif op == 0xCD:
-            addr = self.memory[self._PC]
-            self._PC += 1
-            self.CMPC(addr)
-        elif op == 0xD0:
-            self.branch(not self.Z)
-        elif op == 0xE0:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.CPX(value)
-        elif op == 0xE9:
-            value = self.memory[self._PC] | (self.memory[self._PC + 1] << 8)
-            self._PC += 2
-            self.SBC(value)
-        elif op == 0xEA:
-            self.NOP()
-        elif op == 0xF0:
-            self.branch(self.Z)
-        else:
-            raise ValueError(f"Unknown opcode {op:02X}")
+    def _op_BRK(self, _arg):
+        return False
+
+    def _op_STA(self, addr):
+        self.A_to_store(addr)
+        return True
+
+    def _op_LSA(self, addr):
+        self.from_store_to_A(addr)
+        return True
+
+    def _op_STX(self, addr):
+        self.X_to_store(addr)
+        return True
+
+    def _op_LSX(self, addr):
+        self.from_store_to_X(addr)
+        return True
+
+    def _op_CTA(self, _arg):
+        self.from_console_to_A()
+        return True
+
+    def _op_OTT(self, addr):
+        self.Output_to_console(addr)
+        return True
 
+    def _op_MUL(self, addr):
+        self.MUL(addr)
         return True
+
+    def _op_XTA(self, _arg):
+        self.XTA()
+        return True
+
+    def _op_ORA(self, value):
+        self.ORA(value)
+        return True
+
+    def _op_BPL(self, offset):
+        self.branch(not self.N, offset)
+        return True
+
+    def _op_CLA(self, _arg):
+        self.clear_all_flags()
+        return True
+
+    def _op_STAL(self, addr):
+        self.A_to_store_long(addr)
+        return True
+
+    def _op_LSAL(self, addr):
+        self.from_store_long_to_A(addr)
+        return True
+
+    def _op_MULM(self, addr):
+        self.MULM(addr)
+        return True
+
+    def _op_OTTL(self, addr):
+        self.Output_long_to_console(addr)
+        return True
+
+    def _op_MULL(self, addr):
+        self.MULL(addr)
+        return True
+
+    def _op_APA(self, addr):
+        self.addr_plus_a(addr)
+        return True
+
+    def _op_CLC(self, _arg):
+        self.CLC()
+        return True
+
+    def _op_AND(self, value):
+        self.AND(value)
+        return True
+
+    def _op_BMI(self, offset):
+        self.branch(self.N, offset)
+        return True
+
+    def _op_EOR(self, value):
+        self.EOR(value)
+        return True
+
+    def _op_JMP(self, addr):
+        self._PC = addr
+        self.cycles += 3
+        return True
+
+    def _op_BVC(self, offset):
+        self.branch(not self.V, offset)
+        return True
+
+    def _op_ADC(self, value):
+        self.ADC(value)
+        return True
+
+    def _op_BVS(self, offset):
+        self.branch(self.V, offset)
+        return True
+
+    def _op_BCC(self, offset):
+        self.branch(not self.C, offset)
+        return True
+
+    def _op_LDY(self, value):
+        self.LDY(value)
+        return True
+
+    def _op_LDX(self, value):
+        self.LDX(value)
+        return True
+
+    def _op_LDA(self, value):
+        self.LDA(value)
+        return True
+
+    def _op_TAX(self, _arg):
+        self.TAX()
+        return True
+
+    def _op_BCS(self, offset):
+        self.branch(self.C, offset)
+        return True
+
+    def _op_CMP(self, value):
+        self.CMP(value)
+        return True
+
+    def _op_CMPC(self, addr):
+        self.CMPC(addr)
+        return True
+
+    def _op_BNE(self, offset):
+        self.branch(not self.Z, offset)
+        return True
+
+    def _op_CPX(self, value):
+        self.CPX(value)
+        return True
+
+    def _op_SBC(self, value):
+        self.SBC(value)
+        return True
+
+    def _op_NOP(self, _arg):
+        self.NOP()
+        return True
+
+    def _op_BEQ(self, offset):
+        self.branch(self.Z, offset)
+        return True
+
+    def execute_instructions(self):
+        pc = self._PC
+        op = self.memory[pc]
+
+        handler = self._dispatch[op]
+        if handler is None:
+            self._PC = pc + 1
+            raise ValueError(f"Unknown opcode {op:02X}")
+        return handler()
+
+    def run(self, max_steps):
+        memory = self.memory
+        dispatch = self._dispatch
+        steps = 0
+
+        while steps < max_steps:
+            pc = self._PC
+            op = memory[pc]
+
+            handler = dispatch[op]
+            if handler is None:
+                self._PC = pc + 1
+                raise ValueError(f"Unknown opcode {op:02X}")
+            try:
+                cont = handler()
+            except InputRequired:
+                # Rewind onto CTA so the run can be resumed once input arrives.
+                self._PC = pc
+                return steps, False
+
+            steps += 1
+            if not cont:
+                return steps, True
+
+        return steps, False
+
+
+# Handlers close over cpu.memory, so the bytearray must only ever be updated in place.
+def _bind_handler(cpu, size, handler):
+    memory = cpu.memory
+    if size == 2:
+        def bound():
+            pc = cpu._PC
+            cpu._PC = pc + 3
+            return handler(cpu, memory[pc + 1] | (memory[pc + 2] << 8))
+    elif size == 1:
+        def bound():
+            pc = cpu._PC
+            cpu._PC = pc + 2
+            return handler(cpu, memory[pc + 1])
+    else:
+        def bound():
+            cpu._PC += 1
+            return handler(cpu, 0)
+    return bound
+
+
+def _build_handlers(cpu):
+    return [None if entry is None else _bind_handler(cpu, *entry) for entry in _DECODE]
+
+
+_DECODE: list[tuple[int, Callable[[CPU6502, int], bool]] | None] = [None] * 256
+_DECODE[0x00] = (0, CPU6502._op_BRK)
+_DECODE[0x01] = (1, CPU6502._op_STA)
+_DECODE[0x02] = (1, CPU6502._op_LSA)
+_DECODE[0x03] = (1, CPU6502._op_STX)
+_DECODE[0x04] = (1, CPU6502._op_LSX)
+_DECODE[0x05] = (0, CPU6502._op_CTA)
+_DECODE[0x06] = (1, CPU6502._op_OTT)
+_DECODE[0x07] = (1, CPU6502._op_MUL)
+_DECODE[0x08] = (0, CPU6502._op_XTA)
+_DECODE[0x09] = (2, CPU6502._op_ORA)
+_DECODE[0x10] = (1, CPU6502._op_BPL)
+_DECODE[0x11] = (0, CPU6502._op_CLA)
+_DECODE[0x12] = (1, CPU6502._op_STAL)
+_DECODE[0x13] = (1, CPU6502._op_LSAL)
+_DECODE[0x14] = (1, CPU6502._op_MULM)
+_DECODE[0x15] = (1, CPU6502._op_OTTL)
+_DECODE[0x16] = (1, CPU6502._op_MULL)
+_DECODE[0x17] = (1, CPU6502._op_APA)
+_DECODE[0x18] = (0, CPU6502._op_CLC)
+_DECODE[0x29] = (2, CPU6502._op_AND)
+_DECODE[0x30] = (1, CPU6502._op_BMI)
+_DECODE[0x49] = (2, CPU6502._op_EOR)
+_DECODE[0x4C] = (2, CPU6502._op_JMP)
+_DECODE[0x50] = (1, CPU6502._op_BVC)
+_DECODE[0x69] = (2, CPU6502._op_ADC)
+_DECODE[0x70] = (1, CPU6502._op_BVS)
+_DECODE[0x90] = (1, CPU6502._op_BCC)
+_DECODE[0xA0] = (2, CPU6502._op_LDY)
+_DECODE[0xA2] = (2, CPU6502._op_LDX)
+_DECODE[0xA9] = (2, CPU6502._op_LDA)
+_DECODE[0xAA] = (0, CPU6502._op_TAX)
+_DECODE[0xB0] = (1, CPU6502._op_BCS)
+_DECODE[0xC9] = (2, CPU6502._op_CMP)
+_DECODE[0xCD] = (1, CPU6502._op_CMPC)
+_DECODE[0xD0] = (1, CPU6502._op_BNE)
+_DECODE[0xE0] = (2, CPU6502._op_CPX)
+_DECODE[0xE9] = (2, CPU6502._op_SBC)
+_DECODE[0xEA] = (0, CPU6502._op_NOP)
+_DECODE[0xF0] = (1, CPU6502._op_BEQ)
@@ -1,17 +1,28 @@
 from __future__ import annotations
 
 import json
+import threading
 from json import JSONDecodeError
-from typing import Any
+from typing import Any, Iterator
 
-from django.http import HttpRequest, JsonResponse
+from django.http import HttpRequest, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
 
-from assembler import ProgramSession, assemble_source, create_session, run_program
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+from CPU import CPU6502
+from assembler import ProgramSession, assemble_source, create_session, run_session
 
 
 SESSIONS: dict[str, ProgramSession] = {}
+TRACE_CHUNK_STEPS = 64
+MAX_STEPS_LIMIT = 200_000
+# One-shot runs reuse a CPU per worker thread; interactive sessions keep their own.
+_RUN_CPU = threading.local()
 
 
 def _read_json(request: HttpRequest) -> dict[str, Any]:
@@ -27,6 +38,40 @@ def _read_json(request: HttpRequest) -> dict[str, Any]:
     return payload
 
 
+def _read_max_steps(payload: dict[str, Any]) -> int:
+    # Runs execute on the request thread, so cap them to keep one client from pinning a worker.
+    return min(max(1, int(payload.get("maxSteps", 1000))), MAX_STEPS_LIMIT)
+
+
+def _run_cpu() -> CPU6502:
+    cpu = getattr(_RUN_CPU, "cpu", None)
+    if cpu is None:
+        cpu = _RUN_CPU.cpu = CPU6502()
+    return cpu
+
+
+def _dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def _session_response(session: ProgramSession) -> StreamingHttpResponse:
+    # Encode the trace chunk by chunk so long runs never hold the whole JSON body in memory.
+    head = _dumps(session.to_response(include_trace=False))
+    chunks = session.iter_trace_chunks(TRACE_CHUNK_STEPS)
+
+    def body() -> Iterator[bytes]:
+        yield head[:-1] + b', "trace": ['
+        separator = b""
+        for steps in chunks:
+            yield separator + _dumps(steps)[1:-1]
+            separator = b", "
+        yield b"]}"
+
+    return StreamingHttpResponse(body(), content_type="application/json")
+
+
 @require_GET
 def health(_request: HttpRequest) -> JsonResponse:
     return JsonResponse({"status": "ok"})
@@ -39,52 +84,64 @@ def assemble_view(request: HttpRequest) -> JsonResponse:
         payload = _read_json(request)
         source = str(payload.get("source", ""))
         program = assemble_source(source)
-        return JsonResponse({"program": program})
+        return JsonResponse({"program": list(program)})
     except Exception as exc:  # noqa: BLE001
         return JsonResponse({"error": str(exc)}, status=400)
 
 
 @csrf_exempt
 @require_POST
-def run_view(request: HttpRequest) -> JsonResponse:
+def run_view(request: HttpRequest) -> JsonResponse | StreamingHttpResponse:
     try:
         payload = _read_json(request)
         source = str(payload.get("source", ""))
-        max_steps = int(payload.get("maxSteps", 1000))
+        max_steps = _read_max_steps(payload)
         inputs = payload.get("inputs", [])
         if not isinstance(inputs, list):
             raise ValueError("'inputs' must be an array")
 
         parsed_inputs = [int(value) for value in inputs]
-        result = run_program(source=source, max_steps=max_steps, inputs=parsed_inputs)
-        return JsonResponse(result)
+        session = run_session(
+            source=source,
+            max_steps=max_steps,
+            inputs=parsed_inputs,
+            trace=bool(payload.get("trace", True)),
+            memory_snapshot_every=int(payload.get("memorySnapshotEvery", 1)),
+            cpu=_run_cpu(),
+        )
+        return _session_response(session)
     except Exception as exc:  # noqa: BLE001
         return JsonResponse({"error": str(exc)}, status=400)
 
 
 @csrf_exempt
 @require_POST
-def start_session_view(request: HttpRequest) -> JsonResponse:
+def start_session_view(request: HttpRequest) -> JsonResponse | StreamingHttpResponse:
     try:
         payload = _read_json(request)
         source = str(payload.get("source", ""))
-        max_steps = int(payload.get("maxSteps", 1000))
-
-        session = create_session(source=source, max_steps=max_steps)
+        max_steps = _read_max_steps(payload)
+
+        session = create_session(
+            source=source,
+            max_steps=max_steps,
+            trace=bool(payload.get("trace", True)),
+            memory_snapshot_every=int(payload.get("memorySnapshotEvery", 1)),
+        )
         SESSIONS[session.session_id] = session
         session.execute_until_pause()
 
         if session.halted or session.error:
             SESSIONS.pop(session.session_id, None)
 
-        return JsonResponse(session.to_response())
+        return _session_response(session)
     except Exception as exc:  # noqa: BLE001
         return JsonResponse({"error": str(exc)}, status=400)
 
 
 @csrf_exempt
 @require_POST
-def input_view(request: HttpRequest) -> JsonResponse:
+def input_view(request: HttpRequest) -> JsonResponse | StreamingHttpResponse:
     try:
         payload = _read_json(request)
         session_id = str(payload.get("sessionId", ""))
@@ -104,6 +161,6 @@ def input_view(request: HttpRequest) -> JsonResponse:
         if session.halted or session.error:
             SESSIONS.pop(session.session_id, None)
 
-        return JsonResponse(session.to_response())
+        return _session_response(session)
     except Exception as exc:  # noqa: BLE001
         return JsonResponse({"error": str(exc)}, status=400)
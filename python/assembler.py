@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import re
+from bisect import insort
 from dataclasses import dataclass, field
-from typing import Any
+from typing import Any, Iterator, NamedTuple
 from uuid import uuid4
 
-from CPU import CPU6502, InputRequired
+from CPU import CPU6502, CPUState, InputRequired
 
 
 OPCODES = {
@@ -54,13 +56,12 @@ ABSOLUTE_ADDR = {"JMP"}
 IMM16_OPS = {"LDA", "LDX", "LDY", "ADC", "SBC", "CMP", "CPX", "AND", "ORA", "EOR"}
 BRANCH_OPS = {"BNE", "BEQ", "BCC", "BCS", "BMI", "BPL", "BVS", "BVC"}
 
+_OP_SIZE = dict.fromkeys(OPCODES, 2)
+_OP_SIZE.update(dict.fromkeys(NO_ARG, 1))
+_OP_SIZE.update(dict.fromkeys(IMM16_OPS | ABSOLUTE_ADDR, 3))
 
-def _instruction_size(op: str) -> int:
-    if op in NO_ARG:
-        return 1
-    if op in IMM16_OPS or op in ABSOLUTE_ADDR:
-        return 3
-    return 2
+# Optional "label:" prefix, up to two tokens, then anything left before a ';' or '#' comment.
+_LINE_RE = re.compile(r"(?:([^:;#]*):)?\s*([^\s;#]*)\s*([^\s;#]*)\s*([^;#]*)")
 
 
 def _parse_number(token: str) -> int:
@@ -71,34 +72,31 @@ def _parse_source(source: str) -> list[dict[str, Any]]:
     statements: list[dict[str, Any]] = []
 
     for raw_line in source.splitlines():
-        line = raw_line.split(";", 1)[0].split("#", 1)[0].strip()
-        if not line:
-            continue
+        label, op, arg, extra = _LINE_RE.match(raw_line).groups()
 
-        if ":" in line:
-            head, tail = line.split(":", 1)
-            label = head.strip()
+        if label is not None:
+            label = label.strip()
             if label:
                 statements.append({"type": "label", "value": label})
-            line = tail.strip()
-            if not line:
-                continue
 
-        parts = line.split()
-        op = parts[0].upper()
-        arg = parts[1] if len(parts) > 1 else None
-        if len(parts) > 2:
+        if not op:
+            continue
+        if extra:
             raise ValueError(f"Too many tokens in line: '{raw_line}'")
 
-        if op in OPCODES:
-            statements.append({"type": "instruction", "op": op, "arg": arg})
+        op = op.upper()
+        opcode = OPCODES.get(op)
+        if opcode is not None:
+            statements.append(
+                {"type": "instruction", "op": op, "arg": arg or None, "opcode": opcode, "size": _OP_SIZE[op]}
+            )
         else:
             statements.append({"type": "byte", "value": op})
 
     return statements
 
 
-def assemble_source(source: str) -> list[int]:
+def assemble_source(source: str) -> bytes:
     statements = _parse_source(source)
     labels: dict[str, int] = {}
     addr = 0
@@ -108,11 +106,11 @@ def assemble_source(source: str) -> list[int]:
             labels[statement["value"]] = addr
             continue
         if statement["type"] == "instruction":
-            addr += _instruction_size(statement["op"])
+            addr += statement["size"]
             continue
         addr += 1
 
-    program: list[int] = []
+    program = bytearray()
     addr = 0
 
     for statement in statements:
@@ -122,10 +120,11 @@ def assemble_source(source: str) -> list[int]:
         if statement["type"] == "instruction":
             op = statement["op"]
             arg = statement["arg"]
-            program.append(OPCODES[op])
+            size = statement["size"]
+            program.append(statement["opcode"])
             addr += 1
 
-            if op in NO_ARG:
+            if size == 1:
                 continue
 
             if arg is None:
@@ -139,7 +138,7 @@ def assemble_source(source: str) -> list[int]:
                         raise ValueError(f"Branch offset out of range for '{op} {arg}': {offset}")
                     program.append(offset & 0xFF)
                     addr += 1
-                elif op in ABSOLUTE_ADDR or op in IMM16_OPS:
+                elif size == 3:
                     program.append(target & 0xFF)
                     program.append((target >> 8) & 0xFF)
                     addr += 2
@@ -149,7 +148,7 @@ def assemble_source(source: str) -> list[int]:
                 continue
 
             value = _parse_number(arg)
-            if op in ABSOLUTE_ADDR or op in IMM16_OPS:
+            if size == 3:
                 program.append(value & 0xFF)
                 program.append((value >> 8) & 0xFF)
                 addr += 2
@@ -162,113 +161,217 @@ def assemble_source(source: str) -> list[int]:
         program.append(value & 0xFF)
         addr += 1
 
-    return program
+    return bytes(program)
 
 
-def run_program(source: str, max_steps: int = 1000, inputs: list[int] | None = None) -> dict[str, Any]:
-    session = create_session(source=source, max_steps=max_steps)
+def run_program(
+    source: str,
+    max_steps: int = 1000,
+    inputs: list[int] | None = None,
+    trace: bool = True,
+    memory_snapshot_every: int = 1,
+) -> dict[str, Any]:
+    return run_session(
+        source=source,
+        max_steps=max_steps,
+        inputs=inputs,
+        trace=trace,
+        memory_snapshot_every=memory_snapshot_every,
+    ).to_response()
+
+
+def run_session(
+    source: str,
+    max_steps: int = 1000,
+    inputs: list[int] | None = None,
+    trace: bool = True,
+    memory_snapshot_every: int = 1,
+    cpu: CPU6502 | None = None,
+) -> ProgramSession:
+    session = create_session(
+        source=source,
+        max_steps=max_steps,
+        trace=trace,
+        memory_snapshot_every=memory_snapshot_every,
+        cpu=cpu,
+    )
     if inputs:
         session.input_values.extend(int(value) for value in inputs)
     session.execute_until_pause()
-    return session.to_response()
+    return session
+
+
+class TraceStep(NamedTuple):
+    step: int
+    opcode: int
+    before: tuple[int, ...]
+    memory_used: tuple[tuple[int, int], ...] | None = None
+    after: tuple[int, ...] | None = None
+    halted: bool = False
+    error: str | None = None
+
+    def to_dict(self) -> dict[str, Any]:
+        entry: dict[str, Any] = {"step": self.step, "opcode": self.opcode, "before": CPUState._make(self.before).to_dict()}
+        if self.error is not None:
+            entry["error"] = self.error
+        else:
+            entry["after"] = CPUState._make(self.after).to_dict()
+            entry["halted"] = self.halted
+        if self.memory_used is not None:
+            entry["memory_used"] = [{"address": addr, "value": value} for addr, value in self.memory_used]
+        return entry
 
 
 @dataclass
 class ProgramSession:
     source: str
     max_steps: int
-    program: list[int]
+    program: bytes
     cpu: CPU6502
     session_id: str = field(default_factory=lambda: uuid4().hex)
     input_values: list[int] = field(default_factory=list)
     outputs: list[dict[str, int]] = field(default_factory=list)
-    trace: list[dict[str, Any]] = field(default_factory=list)
-    occupied_addresses: set[int] = field(default_factory=set)
+    trace: list[TraceStep] = field(default_factory=list)
+    occupied_addresses: list[int] = field(default_factory=list)
+    occupied_bitmap: bytearray = field(default_factory=lambda: bytearray(65536 // 8))
     halted: bool = False
     waiting_input: bool = False
     error: str | None = None
     steps_executed: int = 0
+    trace_enabled: bool = True
+    memory_snapshot_every: int = 1
+
+    def snapshot_occupied_memory(self) -> tuple[tuple[int, int], ...]:
+        memory = self.cpu.memory
+        return tuple((addr, memory[addr]) for addr in self.occupied_addresses)
 
-    def snapshot_occupied_memory(self) -> list[dict[str, int]]:
-        return [
-            {"address": addr & 0xFFFF, "value": self.cpu.memory[addr] & 0xFF}
-            for addr in sorted(self.occupied_addresses)
-        ]
+    def mark_occupied(self, addr: int) -> None:
+        addr &= 0xFFFF
+        bit = 1 << (addr & 7)
+        if self.occupied_bitmap[addr >> 3] & bit:
+            return
+        self.occupied_bitmap[addr >> 3] |= bit
+        insort(self.occupied_addresses, addr)
 
     def provide_input(self, value: int) -> None:
         self.input_values.append(int(value) & CPU6502.MASK32)
         self.waiting_input = False
 
     def execute_until_pause(self) -> None:
+        if self.trace_enabled:
+            self._execute_traced()
+        else:
+            self._execute_untraced()
+
+        if self.steps_executed >= self.max_steps and not self.halted and not self.waiting_input and not self.error:
+            self.error = f"Exceeded max_steps={self.max_steps}"
+
+    def _execute_untraced(self) -> None:
+        if self.halted or self.error:
+            return
+
+        try:
+            steps, halted = self.cpu.run(self.max_steps - self.steps_executed)
+        except Exception as exc:  # noqa: BLE001
+            self.error = str(exc)
+            return
+
+        self.steps_executed += steps
+        if halted:
+            self.halted = True
+        elif self.steps_executed < self.max_steps:
+            self.waiting_input = True
+
+    def _execute_traced(self) -> None:
+        cpu = self.cpu
+        memory = cpu.memory
+
         while self.steps_executed < self.max_steps and not self.halted and not self.error:
-            before = self.cpu.snapshot()
-            op = self.cpu.memory[self.cpu._PC]
+            before = cpu.snapshot_tuple()
+            pc = cpu._PC
+            op = memory[pc]
 
             if op == 0x05 and not self.input_values:
                 self.waiting_input = True
                 break
 
-            if op in {0x01, 0x03, 0x14}:
-                target = self.cpu.memory[(self.cpu._PC + 1) & 0xFFFF]
-                self.occupied_addresses.add(target & 0xFFFF)
-                self.occupied_addresses.add((target + 1) & 0xFFFF)
+            if op == 0x01 or op == 0x03 or op == 0x14:
+                target = memory[(pc + 1) & 0xFFFF]
+                self.mark_occupied(target)
+                self.mark_occupied(target + 1)
             elif op == 0x12:
-                target = self.cpu.memory[(self.cpu._PC + 1) & 0xFFFF]
+                target = memory[(pc + 1) & 0xFFFF]
                 for offset in range(4):
-                    self.occupied_addresses.add((target + offset) & 0xFFFF)
+                    self.mark_occupied(target + offset)
 
             try:
-                cont = self.cpu.execute_instructions()
+                cont = cpu.execute_instructions()
             except InputRequired:
                 self.waiting_input = True
                 break
             except Exception as exc:  # noqa: BLE001
                 self.error = str(exc)
                 self.trace.append(
-                    {
-                        "step": self.steps_executed + 1,
-                        "opcode": op,
-                        "before": before,
-                        "error": self.error,
-                        "memory_used": self.snapshot_occupied_memory(),
-                    }
+                    TraceStep(
+                        step=self.steps_executed + 1,
+                        opcode=op,
+                        before=before,
+                        memory_used=self.snapshot_occupied_memory(),
+                        error=self.error,
+                    )
                 )
                 break
 
             self.steps_executed += 1
-            after = self.cpu.snapshot()
+            after = cpu.snapshot_tuple()
+            sample_memory = not cont or self.steps_executed % self.memory_snapshot_every == 0
             self.trace.append(
-                {
-                    "step": self.steps_executed,
-                    "opcode": op,
-                    "before": before,
-                    "after": after,
-                    "halted": not cont,
-                    "memory_used": self.snapshot_occupied_memory(),
-                }
+                TraceStep(
+                    step=self.steps_executed,
+                    opcode=op,
+                    before=before,
+                    memory_used=self.snapshot_occupied_memory() if sample_memory else None,
+                    after=after,
+                    halted=not cont,
+                )
             )
 
             if not cont:
                 self.halted = True
                 break
 
-        if self.steps_executed >= self.max_steps and not self.halted and not self.waiting_input and not self.error:
-            self.error = f"Exceeded max_steps={self.max_steps}"
+    def iter_trace_chunks(self, chunk_size: int = 64) -> Iterator[list[dict[str, Any]]]:
+        trace = self.trace[:]
+        return (
+            [step.to_dict() for step in trace[start : start + chunk_size]]
+            for start in range(0, len(trace), chunk_size)
+        )
 
-    def to_response(self) -> dict[str, Any]:
-        return {
+    def to_response(self, include_trace: bool = True) -> dict[str, Any]:
+        response = {
             "session_id": self.session_id,
-            "program": self.program,
-            "trace": self.trace,
+            "program": list(self.program),
             "halted": self.halted,
             "waiting_input": self.waiting_input,
             "error": self.error,
-            "outputs": self.outputs,
-            "final_state": self.cpu.snapshot(),
+            "outputs": self.outputs[:],
+            "final_state": self.cpu.snapshot_dict(),
         }
+        if include_trace:
+            response["trace"] = [step.to_dict() for step in self.trace]
+        return response
+
 
+def create_session(
+    source: str,
+    max_steps: int = 1000,
+    trace: bool = True,
+    memory_snapshot_every: int = 1,
+    cpu: CPU6502 | None = None,
+) -> ProgramSession:
+    if memory_snapshot_every < 1:
+        raise ValueError("memory_snapshot_every must be at least 1")
 
-def create_session(source: str, max_steps: int = 1000) -> ProgramSession:
     program = assemble_source(source)
     outputs: list[dict[str, int]] = []
     input_values: list[int] = []
@@ -281,10 +384,13 @@ def create_session(source: str, max_steps: int = 1000) -> ProgramSession:
     def output_handler(value: int, addr: int) -> None:
         outputs.append({"value": value & CPU6502.MASK32, "address": addr & 0xFFFF})
 
-    cpu = CPU6502(input_provider=input_provider, output_handler=output_handler)
-    for index, byte in enumerate(program):
-        cpu.memory[index] = byte & 0xFF
-    cpu._PC = 0x0000
+    if cpu is None:
+        cpu = CPU6502(input_provider=input_provider, output_handler=output_handler)
+    else:
+        cpu.reset(input_provider=input_provider, output_handler=output_handler)
+    if len(program) > len(cpu.memory):
+        raise ValueError(f"Program is too large: {len(program)} bytes")
+    cpu.memory[: len(program)] = program
 
     return ProgramSession(
         source=source,
@@ -293,4 +399,6 @@ def create_session(source: str, max_steps: int = 1000) -> ProgramSession:
         cpu=cpu,
         input_values=input_values,
         outputs=outputs,
+        trace_enabled=trace,
+        memory_snapshot_every=memory_snapshot_every,
     )